@@ -1,9 +1,13 @@
 import streamlit as st
 import google.generativeai as genai
+from google import genai as google_genai
 import os
+import io
 import json
+import re
+import numpy as np
 from dotenv import load_dotenv
-from pypdf import PdfReader
+import fitz  # PyMuPDF
 from streamlit_mic_recorder import mic_recorder
 
 # --- 1. SETUP & CONFIGURATION ---
@@ -23,17 +27,117 @@ else:
     st.error("❌ API Key missing! Add GOOGLE_API_KEY to Streamlit Secrets.")
     st.stop()
 
+# Older chat messages are summarized in blocks once more than 2 * HISTORY_WINDOW have
+# piled up, so between HISTORY_WINDOW and 2 * HISTORY_WINDOW recent messages go verbatim.
+HISTORY_WINDOW = 8
+
+# Notes are split into ~300-token chunks; only the most relevant ones are sent per turn.
+NOTES_CHUNK_CHARS = 1200
+RETRIEVAL_TOP_K = 3
+EMBEDDING_MODEL = "models/gemini-embedding-001"
+
+_JSON_DECODER = json.JSONDecoder()
+
+# Bulk re-grading goes through the Gemini Batch API (async, discounted tokens), with
+# several answers bundled per request to cut the request count.
+GRADING_BATCH_SIZE = 4
+GRADING_PROMPT = "Grade each student answer below against the study notes."
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
 # --- 2. CORE LOGIC FUNCTIONS ---
 
+@st.cache_data(show_spinner="Parsing PDF…", persist="disk", max_entries=32)
+def extract_pdf_text(pdf_bytes):
+    """Extracts text from PDF bytes.
+
+    Cached on the bytes and persisted to disk, so re-uploads are free even across restarts.
+    At most 32 entries stay in memory (evicted ones reload from disk), but the disk copy is
+    never evicted and is shared by all users; clear it with extract_pdf_text.clear().
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    parts = []
+    for page in doc:
+        parts.append(page.get_text() or "")
+    doc.close()
+    return "\n".join(parts)
+
+@st.cache_data
+def chunk_notes(pdf_text, chunk_chars=NOTES_CHUNK_CHARS):
+    """Splits the notes into chunks of at most chunk_chars, preferring paragraph boundaries."""
+    pieces = []
+    for para in re.split(r"\n\s*\n", pdf_text):
+        para = " ".join(para.split())
+        while len(para) > chunk_chars:
+            cut = para.rfind(" ", 0, chunk_chars)
+            if cut <= 0: cut = chunk_chars
+            pieces.append(para[:cut])
+            para = para[cut:].lstrip()
+        if para: pieces.append(para)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > chunk_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current: chunks.append(current)
+    return chunks
+
+def notes_outline(chunks):
+    """Builds a compact table of contents: the opening words of every chunk."""
+    return "\n".join(f"- {chunk[:80]}" for chunk in chunks)
+
+@st.cache_data(show_spinner="Indexing notes…")
+def embed_chunks(chunks):
+    """Embeds the note chunks once and returns them as unit-length row vectors."""
+    vectors = []
+    for start in range(0, len(chunks), 100):
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=chunks[start:start + 100], task_type="retrieval_document")
+        vectors.extend(result["embedding"])
+    matrix = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def relevant_notes(query, chunks, top_k=RETRIEVAL_TOP_K):
+    """Returns the top_k chunks most similar to query (the opening chunks if there is no query).
+
+    If retrieval fails, the opening chunks are returned with a note saying so, so the
+    model does not treat them as matched to the topic; the user is warned once per session.
+    """
+    if not chunks:
+        return ""
+    if not query:
+        return "\n\n---\n\n".join(chunks[:top_k])
+    try:
+        vectors = embed_chunks(chunks)
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=query, task_type="retrieval_query")
+        scores = vectors @ np.array(result["embedding"], dtype=np.float32)
+        # Keep the winners in document order so the excerpts read naturally
+        top = sorted(np.argsort(scores)[::-1][:top_k])
+        return "\n\n---\n\n".join(chunks[i] for i in top)
+    except Exception as e:
+        if not st.session_state.get("retrieval_warning_shown"):
+            st.warning(f"Note search is unavailable ({e}); using the opening sections of the notes instead.")
+            st.session_state.retrieval_warning_shown = True
+        fallback = "\n\n---\n\n".join(chunks[:top_k])
+        return f"(Note search failed: these are the opening sections of the notes, not necessarily the current topic.)\n\n{fallback}"
+
+@st.cache_data
 def get_system_instruction(pdf_text):
-    """Constructs the system prompt with the PDF content and Drill-Down rules."""
+    """Constructs the system prompt with the notes outline and Drill-Down rules."""
     return f"""
     You are a strict but fair "Viva Examiner" for a technical interview. 
     Your goal is to quiz the user based ONLY on the provided study notes.
 
-    ### STUDY NOTES:
+    ### STUDY NOTES (OUTLINE):
     {pdf_text}
 
+    Full excerpts for the current topic are attached to each message under "RELEVANT STUDY NOTES".
+    Base your questions and grading on those excerpts; use the outline to pick new topics.
+
     ### EXAM RULES (The "Drill-Down" Protocol):
     1.  **Step 1 (The Hook):** Start by asking a generic, high-level question from the notes.
     2.  **Step 2 (The Drill-Down):**
@@ -45,50 +149,298 @@ def get_system_instruction(pdf_text):
 
     ### RESPONSE FORMAT:
     You must ALWAYS start your response with a JSON object containing the score (0-100) and feedback. Follow it immediately with your spoken response.
+    The student answers by voice: transcribe their audio internally and put the exact transcription in "transcript" (use "" when there is no audio).
     
     Format:
-    {{ "score": 85, "precision_feedback": "Good use of technical terms." }}
+    {{ "score": 85, "precision_feedback": "Good use of technical terms.", "transcript": "Recursion is when a function calls itself." }}
     <Your spoken response to the user here>
     """
 
-def process_audio(audio_bytes):
-    """Transcribes audio bytes to text using Gemini 1.5 Flash."""
+@st.cache_data
+def get_grading_instruction(outline, batch_size):
+    """Constructs the batch grading prompt: notes outline, rubric and JSON array format.
+
+    Each message carries up to batch_size delimited answers; the reply has one entry per answer.
+    """
+    return f"""
+    You are a strict but fair "Viva Examiner" grading answers from a finished technical interview.
+    Grade ONLY against the study notes: the outline below and the excerpts attached to each message under "RELEVANT STUDY NOTES".
+
+    ### STUDY NOTES (OUTLINE):
+    {outline}
+
+    ### GRADING RUBRIC:
+    * **90-100:** Correct and complete, using the precise technical terms from the notes.
+    * **60-89:** Mostly correct, but vague, missing a nuance or using layman terms.
+    * **30-59:** Partially correct with significant gaps or errors.
+    * **0-29:** Wrong, off-topic or no real answer.
+
+    ### RESPONSE FORMAT (BATCH MODE):
+    You will receive up to {batch_size} student answers, each starting with a line "---ANSWER i---".
+    Return ONLY a JSON array with one object per answer, in the same order, and nothing else.
+
+    Format:
+    [{{ "score": 85, "precision_feedback": "Good use of technical terms." }}]
+    """
+
+@st.cache_resource
+def get_model(system_instruction):
+    """Returns a Gemini model bound to the given system instruction, shared across reruns."""
+    return genai.GenerativeModel("gemini-2.5-flash", system_instruction=system_instruction)
+
+def summarize_history(messages, previous_summary=""):
+    """Condenses older exam messages (plus any earlier summary) into a short recap."""
+    transcript = "\n".join(f"{msg['role']}: {msg.get('content_clean', msg['content'])}" for msg in messages)
+    model = get_model("You summarize viva exam transcripts. Keep the topics covered, the questions asked, and how well the student answered. Be brief.")
+    response = model.generate_content(f"Earlier summary:\n{previous_summary}\n\nNew messages:\n{transcript}")
+    return response.text
+
+def trim_history(chat_history):
+    """Returns (summary, recent_messages), keeping the recent messages verbatim.
+
+    Once more than 2 * HISTORY_WINDOW messages are unsummarized, all but the last
+    HISTORY_WINDOW or so are folded into the summary cached in session state, so a new
+    summary is only requested once every HISTORY_WINDOW messages. The recent slice always
+    starts on an assistant message, so it alternates cleanly after the user-role summary.
+    """
+    summarized = st.session_state.get("history_summarized_upto", 0)
+    summary = st.session_state.get("history_summary", "")
+    if summarized > len(chat_history):
+        summarized, summary = 0, ""
+    if len(chat_history) - summarized > 2 * HISTORY_WINDOW:
+        cutoff = len(chat_history) - HISTORY_WINDOW
+        if chat_history[cutoff]["role"] == "user":
+            cutoff += 1
+        summary = summarize_history(chat_history[summarized:cutoff], summary)
+        summarized = cutoff
+        st.session_state.history_summary = summary
+        st.session_state.history_summarized_upto = summarized
+    return summary, chat_history[summarized:]
+
+def parse_response(content):
+    """Splits an examiner message into its leading JSON score header (or {}) and the spoken text."""
+    text = content.lstrip()
+    if text.startswith("{"):
+        try:
+            header, end = _JSON_DECODER.raw_decode(text)
+            if isinstance(header, dict):
+                return header, text[end:].strip()
+        except ValueError:
+            pass
+    return {}, content.strip()
+
+def get_chat(system_instruction, chat_history):
+    """Returns this session's Gemini ChatSession.
+
+    The session is only (re)built from chat_history when it does not exist yet, the
+    system instruction changed, or older messages were just folded into the summary.
+    """
+    summarized_before = st.session_state.get("history_summarized_upto", 0)
+    summary, recent_history = trim_history(chat_history)
+    chat = st.session_state.get("gemini_chat")
+    if (chat is not None
+            and st.session_state.get("gemini_chat_instruction") == system_instruction
+            and st.session_state.get("history_summarized_upto", 0) == summarized_before):
+        return chat
+
+    # Convert chat history to Gemini format
+    gemini_history = []
+    if summary:
+        gemini_history.append({"role": "user", "parts": [f"Summary of the exam so far:\n{summary}"]})
+    for msg in recent_history:
+        role = "user" if msg["role"] == "user" else "model"
+        # Assistant messages carry a JSON-free copy, cleaned once when they were stored
+        gemini_history.append({"role": role, "parts": [msg["content_clean"] if role == "model" else msg["content"]]})
+
+    chat = get_model(system_instruction).start_chat(history=gemini_history)
+    st.session_state.gemini_chat = chat
+    st.session_state.gemini_chat_instruction = system_instruction
+    return chat
+
+def compact_last_turn(user_text, spoken_text):
+    """Rewrites the last exchange in the chat session as plain text.
+
+    This drops the audio and note excerpts from the user turn and the JSON header from the reply,
+    so neither is resent on later turns.
+    """
+    chat = st.session_state.get("gemini_chat")
+    if chat is None:
+        return
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content([
-            "Transcribe the following audio exactly.",
-            {"mime_type": "audio/wav", "data": audio_bytes}
-        ])
-        return response.text
+        history = list(chat.history)
+        history[-2:] = [
+            {"role": "user", "parts": [user_text]},
+            {"role": "model", "parts": [spoken_text]},
+        ]
+        chat.history = history
+    except Exception:
+        # e.g. the streamed turn ended with a blocked finish reason; rebuild it next time
+        st.session_state.pop("gemini_chat", None)
+
+def generate_response(user_input, chat_history, system_instruction, notes=""):
+    """Generates a response from Gemini based on chat history and rules.
+
+    user_input may be text or an audio part ({"mime_type": ..., "data": ...});
+    audio is transcribed and answered in the same call. notes holds the study
+    note excerpts relevant to this turn.
+    """
+    try:
+        chat = get_chat(system_instruction, chat_history)
+        user_parts = [user_input]
+        if notes:
+            user_parts.insert(0, f"### RELEVANT STUDY NOTES:\n{notes}")
+        return chat.send_message(user_parts, stream=True)
     except Exception as e:
-        st.error(f"Error processing audio: {e}")
+        st.error(f"Error generating response: {e}")
+        st.session_state.pop("gemini_chat", None)
         return None
 
-def generate_response(user_input, chat_history, system_instruction):
-    """Generates a response from Gemini based on chat history and rules."""
+def stream_response(response):
+    """Renders a streamed Gemini response as it arrives and returns the full raw text.
+
+    The leading JSON score header is held back so only the spoken part is shown.
+    """
+    raw = []
+
+    def spoken_chunks():
+        buffer = ""
+        header_done = False
+        for chunk in response:
+            raw.append(chunk.text)
+            if header_done:
+                yield chunk.text
+                continue
+            buffer += chunk.text
+            if not buffer.strip():
+                continue
+            if not buffer.lstrip().startswith("{"):
+                header_done = True
+                yield buffer
+                continue
+            try:
+                _, end = _JSON_DECODER.raw_decode(buffer.lstrip())
+            except ValueError:
+                continue  # header not complete yet
+            header_done = True
+            yield buffer.lstrip()[end:].lstrip()
+        if not header_done:
+            yield buffer
+
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash", system_instruction=system_instruction)
-        
-        # Convert chat history to Gemini format
-        gemini_history = []
-        for msg in chat_history:
-            role = "user" if msg["role"] == "user" else "model"
-            content = msg["content"]
-            # Clean out JSON from history to keep context pure
-            if role == "model" and "{" in content:
-                try:
-                    parts = content.split("}", 1)
-                    if len(parts) > 1: content = parts[1].strip()
-                except: pass
-            gemini_history.append({"role": role, "parts": [content]})
-            
-        gemini_history.append({"role": "user", "parts": [user_input]})
-        
-        response = model.generate_content(gemini_history)
-        return response.text
+        st.write_stream(spoken_chunks())
     except Exception as e:
         st.error(f"Error generating response: {e}")
+        # The chat session now holds a half-finished turn; rebuild it next time
+        st.session_state.pop("gemini_chat", None)
         return None
+    return "".join(raw)
+
+@st.cache_resource
+def _batch_client():
+    """Returns the google-genai client used for Batch API jobs."""
+    return google_genai.Client(api_key=api_key)
+
+def session_answers(chat_history):
+    """Pairs every student answer in the session with the examiner question it responds to."""
+    answers = []
+    question = ""
+    for msg in chat_history:
+        if msg["role"] == "assistant":
+            question = msg["content_clean"]
+        else:
+            answers.append(f"Question: {question}\nAnswer: {msg['content']}")
+    return answers
+
+def parse_batch_response(text, count):
+    """Parses a batch-mode reply (a JSON array) into exactly count grade dicts."""
+    grades = []
+    start = text.find("[")
+    if start != -1:
+        try:
+            parsed, _ = _JSON_DECODER.raw_decode(text[start:])
+            grades = [g if isinstance(g, dict) else {} for g in parsed] if isinstance(parsed, list) else []
+        except ValueError:
+            pass
+    return (grades + [{}] * count)[:count]
+
+def submit_grading(answers, notes_chunks):
+    """Uploads the answers as JSONL (GRADING_BATCH_SIZE per request), starts a Batch API job and returns its name."""
+    system_instruction = get_grading_instruction(notes_outline(notes_chunks), GRADING_BATCH_SIZE)
+    lines = []
+    for start in range(0, len(answers), GRADING_BATCH_SIZE):
+        group = answers[start:start + GRADING_BATCH_SIZE]
+        notes = relevant_notes("\n".join(group), notes_chunks)
+        delimited = "\n\n".join(f"---ANSWER {i}---\n{answer}" for i, answer in enumerate(group, start=1))
+        prompt = f"### RELEVANT STUDY NOTES:\n{notes}\n\n{GRADING_PROMPT}\n\n{delimited}"
+        request = {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "system_instruction": {"parts": [{"text": system_instruction}]},
+        }
+        lines.append(json.dumps({"key": f"answers-{start}-{len(group)}", "request": request}))
+
+    client = _batch_client()
+    src = client.files.upload(
+        file=io.BytesIO("\n".join(lines).encode("utf-8")),
+        config={"display_name": "viva-grading", "mime_type": "jsonl"},
+    )
+    job = client.batches.create(model="gemini-2.5-flash", src=src.name, config={"display_name": "viva-grading"})
+    return job.name
+
+def grading_results(job_name):
+    """Returns (state, grades) for a grading job; grades is None until the job has finished."""
+    client = _batch_client()
+    job = client.batches.get(name=job_name)
+    state = job.state.name
+    if state not in BATCH_DONE_STATES:
+        return state, None
+    if state != "JOB_STATE_SUCCEEDED":
+        return state, []
+
+    groups = {}
+    for line in client.files.download(file=job.dest.file_name).decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        _, start, count = item["key"].split("-")
+        try:
+            text = item["response"]["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError):
+            text = ""
+        groups[int(start)] = parse_batch_response(text, int(count))
+    return state, [grade for start in sorted(groups) for grade in groups[start]]
+
+def grading_sidebar():
+    """Sidebar section that re-scores the whole session in one batch job."""
+    st.divider()
+    answers = session_answers(st.session_state.chat_history)
+    if st.button("Grade full session", disabled=not answers):
+        try:
+            st.session_state.grading_job = submit_grading(answers, st.session_state.notes_chunks)
+            st.session_state.grading_state = "JOB_STATE_PENDING"
+            st.session_state.pop("grading_results", None)
+        except Exception as e:
+            st.error(f"Error submitting grading job: {e}")
+
+    # Poll only on request, so pending jobs add no network round trip to exam turns
+    if "grading_job" in st.session_state and st.button("Refresh status"):
+        try:
+            state, grades = grading_results(st.session_state.grading_job)
+            st.session_state.grading_state = state
+            if grades is not None:
+                del st.session_state.grading_job
+                if state == "JOB_STATE_SUCCEEDED":
+                    st.session_state.grading_results = grades
+                else:
+                    st.error(f"Grading job ended with {state}.")
+        except Exception as e:
+            st.error(f"Error checking grading job: {e}")
+
+    if "grading_job" in st.session_state:
+        st.caption(f"Grading in progress ({st.session_state.grading_state}).")
+        return
+
+    for i, grade in enumerate(st.session_state.get("grading_results", []), start=1):
+        st.write(f"**Answer {i}:** {grade.get('score', '–')} — {grade.get('precision_feedback', '')}")
 
 # --- 3. MAIN UI ---
 
@@ -110,35 +462,37 @@ def main():
     if "chat_history" not in st.session_state: st.session_state.chat_history = []
     if "score" not in st.session_state: st.session_state.score = 0
     if "pdf_text" not in st.session_state: st.session_state.pdf_text = None
+    if "notes_chunks" not in st.session_state: st.session_state.notes_chunks = []
+    if "system_instruction" not in st.session_state: st.session_state.system_instruction = "You are a helpful assistant."
+
+    with st.sidebar:
+        grading_sidebar()
 
     # Display Chat History
     for message in st.session_state.chat_history:
         with st.chat_message(message["role"]):
-            content = message["content"]
-            if message["role"] == "assistant" and content.strip().startswith("{"):
-                try:
-                    _, text_part = content.split("}", 1)
-                    st.write(text_part.strip())
-                except:
-                    st.write(content)
-            else:
-                st.write(content)
+            st.write(message["content_clean"] if message["role"] == "assistant" else message["content"])
 
     # PDF Processing
     if uploaded_file and not st.session_state.pdf_text:
-        reader = PdfReader(uploaded_file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text()
-        st.session_state.pdf_text = text
+        pdf_bytes = uploaded_file.getvalue()
+        st.session_state.pdf_text = extract_pdf_text(pdf_bytes)
+        st.session_state.notes_chunks = chunk_notes(st.session_state.pdf_text)
+        st.session_state.system_instruction = get_system_instruction(notes_outline(st.session_state.notes_chunks))
         st.success("PDF Processed! Ready to start.")
         
         # Trigger First Question
         if not st.session_state.chat_history:
-            system_instruction = get_system_instruction(st.session_state.pdf_text)
-            response_text = generate_response("Start the viva. Ask me a question from the notes.", [], system_instruction)
+            notes = relevant_notes("", st.session_state.notes_chunks)
+            response = generate_response("Start the viva. Ask me a question from the notes.", [], st.session_state.system_instruction, notes)
+            response_text = None
+            if response:
+                with st.chat_message("assistant"):
+                    response_text = stream_response(response)
             if response_text:
-                st.session_state.chat_history.append({"role": "assistant", "content": response_text})
+                _, spoken_text = parse_response(response_text)
+                compact_last_turn("Start the viva. Ask me a question from the notes.", spoken_text)
+                st.session_state.chat_history.append({"role": "assistant", "content": response_text, "content_clean": spoken_text})
                 st.rerun()
 
     # Audio Input
@@ -146,27 +500,34 @@ def main():
     audio = mic_recorder(start_prompt="🎤 Answer", stop_prompt="⏹️ Stop", key='recorder')
     
     if audio:
-        st.spinner("Listening...")
-        user_text = process_audio(audio['bytes'])
-        if user_text:
-            st.session_state.chat_history.append({"role": "user", "content": user_text})
-            
-            system_instruction = get_system_instruction(st.session_state.pdf_text) if st.session_state.pdf_text else "You are a helpful assistant."
-            response_text = generate_response(user_text, st.session_state.chat_history[:-1], system_instruction)
+        with st.status("Thinking…", expanded=False) as status:
+            audio_part = {"mime_type": "audio/wav", "data": audio['bytes']}
+            # Retrieve notes for the question being answered (the examiner's last message)
+            last_question = next((m["content_clean"] for m in reversed(st.session_state.chat_history) if m["role"] == "assistant"), "")
+            notes = relevant_notes(last_question, st.session_state.notes_chunks)
+            response = generate_response(audio_part, st.session_state.chat_history, st.session_state.system_instruction, notes)
+            if response:
+                status.update(label="Done", state="complete")
+            else:
+                status.update(label="Something went wrong", state="error", expanded=True)
+        response_text = None
+        if response:
+            with st.chat_message("assistant"):
+                response_text = stream_response(response)
+        
+        if response_text:
+            # Parse JSON for Score Update and the echoed transcript
+            user_text = "🎤 (voice answer)"
+            json_data, spoken_text = parse_response(response_text)
+            if json_data:
+                st.session_state.score = json_data.get("score", st.session_state.score)
+                st.session_state.precision_feedback = json_data.get("precision_feedback", "")
+                user_text = json_data.get("transcript") or user_text
             
-            if response_text:
-                # Parse JSON for Score Update
-                try:
-                    if response_text.strip().startswith("{"):
-                        json_str, _ = response_text.split("}", 1)
-                        json_data = json.loads(json_str + "}")
-                        st.session_state.score = json_data.get("score", st.session_state.score)
-                        st.session_state.precision_feedback = json_data.get("precision_feedback", "")
-                except:
-                    pass
-                
-                st.session_state.chat_history.append({"role": "assistant", "content": response_text})
-                st.rerun()
+            compact_last_turn(user_text, spoken_text)
+            st.session_state.chat_history.append({"role": "user", "content": user_text})
+            st.session_state.chat_history.append({"role": "assistant", "content": response_text, "content_clean": spoken_text})
+            st.rerun()
 
 if __name__ == "__main__":
     main()